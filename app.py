@@ -1,11 +1,27 @@
 # app.py
-from flask import Flask, jsonify, render_template
+from flask import Flask, jsonify, render_template, request, g, abort, send_from_directory, has_request_context
 from flask_cors import CORS
 from flask_caching import Cache
 from dotenv import load_dotenv
 import requests
 import os
 import math
+import time
+import re
+import json
+import hmac
+import codecs
+import uuid
+import threading
+import cProfile
+from collections import Counter
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+try:
+    import fcntl
+except ImportError:  # Windows - the scheduler falls back to a process-local lock
+    fcntl = None
 
 load_dotenv()
 
@@ -30,6 +46,358 @@ TOP_ARTISTS_WEEK_LIMIT = int(os.getenv('TOP_ARTISTS_WEEK_LIMIT', '10'))
 TOP_ARTISTS_YEAR_LIMIT = int(os.getenv('TOP_ARTISTS_YEAR_LIMIT', '10'))
 SHOW_RECENT_TRACKS_GENRES = os.getenv('SHOW_RECENT_TRACKS_GENRES', 'true').lower() == 'true'
 
+LASTFM_API_URL = 'https://ws.audioscrobbler.com/2.0/'
+
+# Admin configuration - admin endpoints are disabled unless a token is set
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# Request profiling configuration
+PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', 'false').lower() == 'true'
+PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/last_fm_profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '50'))
+
+# Upstream scheduler configuration - the rate budget is shared by every worker process
+LASTFM_RATE_LIMIT = float(os.getenv('LASTFM_RATE_LIMIT', '5'))  # Calls per second, 0 disables scheduling
+LASTFM_RATE_BURST = float(os.getenv('LASTFM_RATE_BURST', '10'))
+BACKGROUND_RESERVE = float(os.getenv('BACKGROUND_RESERVE', '3'))  # Tokens background work must leave for interactive calls
+SCHEDULER_MAX_WAIT = float(os.getenv('SCHEDULER_MAX_WAIT', '30'))
+SCHEDULER_STATE_FILE = os.getenv('SCHEDULER_STATE_FILE', '/tmp/last_fm_scheduler.json')
+
+# Priority classes, most latency-sensitive first
+PRIORITY_NOW_PLAYING = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ['nowPlaying', 'interactive', 'background']
+
+_scheduler_lock = threading.Lock()
+
+@contextmanager
+def file_lock(path, thread_lock):
+    """Hold an exclusive lock shared by threads (thread_lock) and processes (flock on path)"""
+    with thread_lock, open(path, 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_json(path, data):
+    """Write JSON via a temp file so readers never see a partial file"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+@contextmanager
+def scheduler_state():
+    """Lock, load and (on exit) save the shared scheduler state"""
+    with file_lock(SCHEDULER_STATE_FILE + '.lock', _scheduler_lock):
+        state = load_json(SCHEDULER_STATE_FILE, {})
+        state.setdefault('tokens', LASTFM_RATE_BURST)
+        state.setdefault('updated', time.time())
+        state.setdefault('waiting', {})
+        state.setdefault('granted', {name: 0 for name in PRIORITY_NAMES})
+        state.setdefault('queuedSeconds', {name: 0.0 for name in PRIORITY_NAMES})
+
+        yield state
+
+        save_json(SCHEDULER_STATE_FILE, state)
+
+def refill_tokens(state, now):
+    elapsed = max(0.0, now - state['updated'])
+    state['tokens'] = min(LASTFM_RATE_BURST, state['tokens'] + elapsed * LASTFM_RATE_LIMIT)
+    state['updated'] = now
+
+def acquire_upstream_slot(priority):
+    """Block until the shared rate budget allows a Last.fm call at this priority.
+    A call only goes ahead when nothing of a higher priority is queued, and background
+    calls must leave BACKGROUND_RESERVE tokens for interactive ones. Returns seconds queued"""
+    if LASTFM_RATE_LIMIT <= 0:
+        return 0.0
+
+    ticket = uuid.uuid4().hex
+    started = time.time()
+    needed = 1 + (BACKGROUND_RESERVE if priority == PRIORITY_BACKGROUND else 0)
+
+    while True:
+        with scheduler_state() as state:
+            now = time.time()
+            refill_tokens(state, now)
+
+            # Forget waiters whose process died while queued
+            waiting = state['waiting']
+            for other, (_, expires) in list(waiting.items()):
+                if expires < now:
+                    del waiting[other]
+
+            higher_queued = any(p < priority for p, _ in waiting.values())
+            timed_out = now - started >= SCHEDULER_MAX_WAIT
+            if (not higher_queued and state['tokens'] >= needed) or timed_out:
+                if timed_out:
+                    print(f"Scheduler wait exceeded {SCHEDULER_MAX_WAIT}s for {PRIORITY_NAMES[priority]} call, proceeding")
+                waiting.pop(ticket, None)
+                state['tokens'] -= 1
+                name = PRIORITY_NAMES[priority]
+                state['granted'][name] += 1
+                state['queuedSeconds'][name] += now - started
+                return now - started
+
+            # Polling refreshes the expiry, so only abandoned tickets go stale
+            waiting[ticket] = [priority, now + 2]
+            sleep_for = (needed - state['tokens']) / LASTFM_RATE_LIMIT if not higher_queued else 0.05
+
+        time.sleep(min(max(sleep_for, 0.01), 0.25))
+
+def scheduler_snapshot():
+    """Current token budget, queue depth per priority class and lifetime grant stats"""
+    with scheduler_state() as state:
+        now = time.time()
+        refill_tokens(state, now)
+        queue_depth = {name: 0 for name in PRIORITY_NAMES}
+        for priority, expires in state['waiting'].values():
+            if expires >= now:
+                queue_depth[PRIORITY_NAMES[priority]] += 1
+
+        return {
+            'rateLimit': LASTFM_RATE_LIMIT,
+            'burst': LASTFM_RATE_BURST,
+            'tokens': round(state['tokens'], 2),
+            'queueDepth': queue_depth,
+            'granted': state['granted'],
+            'avgQueuedMs': {
+                name: round(state['queuedSeconds'][name] / state['granted'][name] * 1000, 1) if state['granted'][name] else 0
+                for name in PRIORITY_NAMES
+            }
+        }
+
+def lastfm_get(params, priority=PRIORITY_INTERACTIVE, timeout=10, stream=False):
+    """GET a Last.fm API method through the shared upstream scheduler.
+    Queue and upstream waits are recorded so profiles can separate them from CPU time"""
+    try:
+        queued = acquire_upstream_slot(priority)
+    except OSError as e:
+        # Never fail a request because the scheduler state is unavailable
+        print(f"Upstream scheduler unavailable: {str(e)}")
+        queued = 0.0
+    record_queue_wait(queued)
+
+    started = time.perf_counter()
+    try:
+        return requests.get(LASTFM_API_URL, params=params, timeout=timeout, stream=stream)
+    finally:
+        record_upstream_wait(time.perf_counter() - started)
+
+def record_queue_wait(seconds):
+    """Add scheduler queue time to the current request's totals (no-op outside a request)"""
+    if not has_request_context():
+        return
+    g.queue_wait = g.get('queue_wait', 0.0) + seconds
+
+def record_upstream_wait(seconds, calls=1):
+    """Add an upstream wait to the current request's totals (no-op outside a request)"""
+    if not has_request_context():
+        return
+    g.upstream_wait = g.get('upstream_wait', 0.0) + seconds
+    g.upstream_calls = g.get('upstream_calls', 0) + calls
+
+class RecentTrack(object):
+    """Compact scrobble from user.getrecenttracks, keeping only the fields we use"""
+    __slots__ = ('artist', 'name', 'album', 'uts', 'now_playing')
+
+    def __init__(self, artist, name, album, uts, now_playing):
+        self.artist = artist
+        self.name = name
+        self.album = album
+        self.uts = uts
+        self.now_playing = now_playing
+
+    @classmethod
+    def from_json(cls, track):
+        artist = track.get('artist', '')
+        if isinstance(artist, dict):
+            # extended=1 responses use 'name' instead of '#text'
+            artist = artist.get('#text') or artist.get('name', '')
+
+        album = track.get('album', '')
+        if isinstance(album, dict):
+            album = album.get('#text', '')
+
+        date = track.get('date')
+        uts = int(date['uts']) if isinstance(date, dict) and 'uts' in date else None
+
+        attr = track.get('@attr')
+        now_playing = isinstance(attr, dict) and attr.get('nowplaying') == 'true'
+
+        return cls(artist, track.get('name', ''), album, uts, now_playing)
+
+# Matches the start of recenttracks.track, which is a list (or a lone object for single results)
+RECENT_TRACKS_START = re.compile(r'"track"\s*:\s*([\[{])')
+# recenttracks' own @attr (page, totalPages, ...), searched for outside the track list only
+RECENT_TRACKS_ATTR = re.compile(r'"@attr"\s*:\s*(\{[^{}]*\})')
+
+class LastfmError(requests.RequestException):
+    """Last.fm replied with an error body instead of data"""
+
+def iter_recent_tracks(params, priority=PRIORITY_INTERACTIVE, page_info=None, chunk_size=16384):
+    """Stream a user.getrecenttracks response, yielding a RecentTrack per item.
+    Items are decoded one at a time as the body arrives, so peak memory is bounded by
+    one chunk plus one track no matter how large the page is.
+    Error replies raise (HTTPError or LastfmError). If page_info is given it is filled with
+    recenttracks' @attr (page, totalPages, ...) once the whole response has been read"""
+    response = lastfm_get(params, priority=priority, stream=True)
+    chunks = response.iter_content(chunk_size)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    json_decoder = json.JSONDecoder()
+
+    buffer = ''
+    pos = 0
+    in_array = None  # Unknown until the track key has been found
+    items_done = False
+    outside = ''  # Text around the track list, where @attr lives
+
+    try:
+        response.raise_for_status()
+
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            record_upstream_wait(time.perf_counter() - started, calls=0)
+            if chunk is None:
+                break
+
+            buffer = buffer[pos:] + text_decoder.decode(chunk)
+            pos = 0
+
+            if items_done:
+                outside += buffer
+                buffer = ''
+                continue
+
+            if in_array is None:
+                match = RECENT_TRACKS_START.search(buffer)
+                if not match:
+                    # Keep everything so far: the key may be split across chunks, and
+                    # a reply without it is an error body we need to read whole
+                    continue
+                outside = buffer[:match.start()]
+                in_array = match.group(1) == '['
+                pos = match.end() if in_array else match.start(1)
+
+            # Decode every complete item currently in the buffer
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos >= len(buffer):
+                    break
+                if in_array and buffer[pos] == ']':
+                    items_done = True
+                    pos += 1
+                    break
+
+                try:
+                    item, pos = json_decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    # Item continues in the next chunk
+                    break
+
+                yield RecentTrack.from_json(item)
+                if not in_array:
+                    items_done = True
+                    break
+
+            if items_done:
+                outside += buffer[pos:]
+                buffer = ''
+                pos = 0
+
+        if in_array is None:
+            # No track list at all - only an error reply looks like this
+            try:
+                body = json.loads(buffer)
+            except ValueError:
+                raise LastfmError('Unreadable user.getrecenttracks reply')
+            if 'error' in body:
+                raise LastfmError(f"Last.fm error {body['error']}: {body.get('message', '')}")
+            outside = buffer
+
+        if page_info is not None:
+            match = RECENT_TRACKS_ATTR.search(outside)
+            if match:
+                page_info.update(json.loads(match.group(1)))
+    finally:
+        response.close()
+
+def is_admin_request():
+    """Check the admin token from the X-Admin-Token header or ?token= query parameter"""
+    if not ADMIN_TOKEN:
+        return False
+    token = request.headers.get('X-Admin-Token') or request.args.get('token', '')
+    # compare_digest only accepts ASCII str, so compare the UTF-8 bytes
+    return hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+def profiled_path():
+    """Request path and query string with the admin token removed, safe to store in profiles"""
+    query = urlencode([(key, value) for key, value in request.args.items(multi=True) if key != 'token'])
+    return f'{request.path}?{query}' if query else request.path
+
+def should_profile_request():
+    """Profile when enabled globally, or when an admin asks for it with X-Profile: true"""
+    if request.path.startswith('/api/admin/'):
+        return False
+    if PROFILE_REQUESTS:
+        return True
+    return request.headers.get('X-Profile', '').lower() == 'true' and is_admin_request()
+
+def is_profiling():
+    """True while the current request is being profiled; used to bypass the response cache"""
+    return has_request_context() and 'profiler' in g
+
+def save_profile(profiler, meta):
+    """Write a pstats dump plus a JSON sidecar describing the request, then prune old profiles"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+    route_slug = ''.join(c if c.isalnum() else '_' for c in meta['route']).strip('_') or 'index'
+    name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{uuid.uuid4().hex[:8]}-{route_slug}"
+    meta['file'] = f'{name}.pstats'
+
+    profiler.dump_stats(os.path.join(PROFILE_DIR, meta['file']))
+    with open(os.path.join(PROFILE_DIR, f'{name}.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # Keep only the newest PROFILE_KEEP profiles
+    stats_files = sorted(f for f in os.listdir(PROFILE_DIR) if f.endswith('.pstats'))
+    for old in stats_files[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else []:
+        for ext in ('.pstats', '.json'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old[:-len('.pstats')] + ext))
+            except OSError:
+                pass
+
+def list_profiles():
+    """Return saved profile metadata, newest first"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
 def calculate_hipster_score(listeners):
     """Calculate hipster score (0-100) based on listener count.
     Lower listeners = higher hipster score"""
@@ -45,14 +413,651 @@ def calculate_hipster_score(listeners):
     score = HIPSTER_BASE_SCORE - (math.log10(listeners) * HIPSTER_SCALE_FACTOR)
     return max(0, min(100, int(score)))  # Clamp between 0-100
 
+# Scrobble history store backing the listening-pattern endpoints
+SCROBBLE_DATA_DIR = os.getenv('SCROBBLE_DATA_DIR', '/tmp/last_fm_data')
+SCROBBLE_PAGE_SIZE = 1000  # getrecenttracks maximum
+SCROBBLE_SYNC_PAGES = int(os.getenv('SCROBBLE_SYNC_PAGES', '5'))
+SCROBBLE_BACKFILL_PAGES = int(os.getenv('SCROBBLE_BACKFILL_PAGES', '3'))
+SCROBBLE_SYNC_INTERVAL = int(os.getenv('SCROBBLE_SYNC_INTERVAL', '60'))
+SCROBBLE_SYNC_CLAIM_TIMEOUT = 300  # seconds before an abandoned sync can be taken over
+GENRE_LOOKUPS_PER_REQUEST = int(os.getenv('GENRE_LOOKUPS_PER_REQUEST', '25'))
+
+_scrobble_data_lock = threading.Lock()
+
+def data_path(name):
+    return os.path.join(SCROBBLE_DATA_DIR, name)
+
+@contextmanager
+def scrobble_data_lock():
+    """Serialize access to the files in SCROBBLE_DATA_DIR across threads and processes"""
+    os.makedirs(SCROBBLE_DATA_DIR, exist_ok=True)
+    with file_lock(data_path('.lock'), _scrobble_data_lock):
+        yield
+
+def fetch_artist_genre(artist_name, priority=PRIORITY_BACKGROUND):
+    """Top tag for an artist, '' when it has none, or None if the lookup failed"""
+    params = {
+        'method': 'artist.getinfo',
+        'artist': artist_name,
+        'api_key': LASTFM_API_KEY,
+        'format': 'json'
+    }
+    try:
+        artist_info = lastfm_get(params, priority=priority).json()
+    except Exception as e:
+        print(f"Error fetching genre for {artist_name}: {str(e)}")
+        return None
+
+    if 'artist' in artist_info and 'tags' in artist_info['artist'] and 'tag' in artist_info['artist']['tags']:
+        tags = artist_info['artist']['tags']['tag']
+        if isinstance(tags, list) and len(tags) > 0:
+            return tags[0]['name'].lower()
+        elif isinstance(tags, dict):
+            return tags['name'].lower()
+    return ''
+
+def resolve_artist_genres(artist_names, limit=GENRE_LOOKUPS_PER_REQUEST):
+    """Return the persisted artist -> genre map after looking up at most `limit` missing artists.
+    Callers pass the most important artists first and must not hold scrobble_data_lock:
+    lookups run unlocked and are merged into the saved map under the lock afterwards"""
+    artist_genres = load_json(data_path('artist_genres.json'), {})
+
+    found = {}
+    looked_up = 0
+    for name in artist_names:
+        if looked_up >= limit:
+            break
+        if name in artist_genres or name in found:
+            continue
+        genre = fetch_artist_genre(name)
+        looked_up += 1
+        if genre is not None:
+            found[name] = genre
+
+    if found:
+        with scrobble_data_lock():
+            artist_genres = load_json(data_path('artist_genres.json'), {})
+            artist_genres.update(found)
+            save_json(data_path('artist_genres.json'), artist_genres)
+    return artist_genres
+
+def read_vocab(name, size):
+    """Read the first `size` bytes of an append-only vocabulary file, one JSON value per line"""
+    try:
+        with open(data_path(name), 'rb') as f:
+            data = f.read(size)
+    except OSError:
+        return []
+    # json.dumps escapes newlines inside values, so the lines join into one JSON array
+    return json.loads('[' + data.decode('utf-8').rstrip('\n').replace('\n', ',') + ']')
+
+def append_vocab(name, size, entries):
+    """Append entries after the first `size` bytes, dropping anything an interrupted save left
+    behind, and return the new committed size"""
+    with open(data_path(name), 'ab') as f:
+        f.truncate(size)
+        f.write(''.join(json.dumps(entry) + '\n' for entry in entries).encode('utf-8'))
+        return f.tell()
+
+class ScrobbleFrame(object):
+    """Scrobble history as parallel columns sorted by time: uts (int64) plus artist_ids and
+    track_ids (int32) interned into the artists and tracks tables.
+    meta tracks sync progress: history is complete in (tail, head], cursor marks an unfinished
+    forward sync and backfillComplete is set once everything before tail has been fetched.
+    The vocabularies are append-only files read on first use, so read-only requests only load
+    the columns; artistsBytes and tracksBytes in meta record how much of each file is committed"""
+
+    def __init__(self, uts, artist_ids, track_ids, meta):
+        self.uts = uts
+        self.artist_ids = artist_ids
+        self.track_ids = track_ids
+        self.meta = meta
+        self._artists = None
+        self._tracks = None  # [artist_id, name] pairs
+        self._artist_index = None
+        self._track_index = None
+        self.rows_added = False
+
+    @classmethod
+    def load(cls):
+        import numpy as np
+
+        meta = load_json(data_path('scrobble_sync.json'), {})
+        try:
+            with np.load(data_path('scrobbles.npz')) as columns:
+                uts = columns['uts']
+                artist_ids = columns['artist_ids']
+                track_ids = columns['track_ids']
+        except (OSError, KeyError, ValueError):
+            uts = np.zeros(0, np.int64)
+            artist_ids = np.zeros(0, np.int32)
+            track_ids = np.zeros(0, np.int32)
+
+        # Arrays, vocabularies and sync state are written in that order, so a row count
+        # mismatch means an interrupted save and the store is rebuilt
+        if meta.get('rows') != len(uts):
+            meta = {}
+            uts, artist_ids, track_ids = uts[:0], artist_ids[:0], track_ids[:0]
+
+        return cls(uts, artist_ids, track_ids, meta)
+
+    @property
+    def artists(self):
+        if self._artists is None:
+            self._artists = read_vocab('scrobble_artists.jsonl', self.meta.get('artistsBytes', 0))
+        return self._artists
+
+    @property
+    def tracks(self):
+        if self._tracks is None:
+            self._tracks = read_vocab('scrobble_tracks.jsonl', self.meta.get('tracksBytes', 0))
+        return self._tracks
+
+    @property
+    def artist_count(self):
+        if self._artists is None:
+            return self.meta.get('artistCount', 0)
+        return len(self._artists)
+
+    def save(self):
+        """Save sync state, rewriting the arrays and appending new vocabulary only if rows were added"""
+        import numpy as np
+
+        if self.rows_added:
+            tmp_path = data_path(f'scrobbles.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, uts=self.uts, artist_ids=self.artist_ids, track_ids=self.track_ids)
+            os.replace(tmp_path, data_path('scrobbles.npz'))
+
+            self.meta['artistsBytes'] = append_vocab('scrobble_artists.jsonl', self.meta.get('artistsBytes', 0),
+                                                     self.artists[self.meta.get('artistCount', 0):])
+            self.meta['tracksBytes'] = append_vocab('scrobble_tracks.jsonl', self.meta.get('tracksBytes', 0),
+                                                    self.tracks[self.meta.get('trackCount', 0):])
+            self.meta['artistCount'] = len(self.artists)
+            self.meta['trackCount'] = len(self.tracks)
+            self.rows_added = False
+
+        self.meta['rows'] = len(self.uts)
+        save_json(data_path('scrobble_sync.json'), self.meta)
+
+    def intern_artist(self, name):
+        if self._artist_index is None:
+            self._artist_index = {name: i for i, name in enumerate(self.artists)}
+        if name not in self._artist_index:
+            self._artist_index[name] = len(self.artists)
+            self.artists.append(name)
+        return self._artist_index[name]
+
+    def intern_track(self, artist_id, name):
+        if self._track_index is None:
+            self._track_index = {(artist_id, name): i for i, (artist_id, name) in enumerate(self.tracks)}
+        key = (artist_id, name)
+        if key not in self._track_index:
+            self._track_index[key] = len(self.tracks)
+            self.tracks.append([artist_id, name])
+        return self._track_index[key]
+
+    def append(self, tracks):
+        """Add RecentTrack scrobbles, keeping the columns sorted by time"""
+        import numpy as np
+
+        if not tracks:
+            return
+        self.rows_added = True
+
+        artist_ids = [self.intern_artist(t.artist) for t in tracks]
+        track_ids = [self.intern_track(artist_id, t.name) for artist_id, t in zip(artist_ids, tracks)]
+
+        uts = np.concatenate([self.uts, np.array([t.uts for t in tracks], np.int64)])
+        order = np.argsort(uts, kind='stable')
+        self.uts = uts[order]
+        self.artist_ids = np.concatenate([self.artist_ids, np.array(artist_ids, np.int32)])[order]
+        self.track_ids = np.concatenate([self.track_ids, np.array(track_ids, np.int32)])[order]
+
+    def genre_ids(self, artist_genres):
+        """Per-scrobble genre ids (-1 when unknown) and the genre names they index"""
+        import numpy as np
+
+        genres = sorted({genre for genre in artist_genres.values() if genre})
+        genre_index = {genre: i for i, genre in enumerate(genres)}
+        lookup = np.array([genre_index.get(artist_genres.get(name, ''), -1) for name in self.artists], np.int32)
+        return lookup[self.artist_ids], genres
+
+    def artists_by_plays(self):
+        """Artist names, most scrobbled first"""
+        import numpy as np
+
+        plays = np.bincount(self.artist_ids, minlength=len(self.artists))
+        return [self.artists[i] for i in np.argsort(-plays, kind='stable')]
+
+def fetch_scrobble_page(after, upto, priority):
+    """Fetch the newest page of scrobbles with after < uts <= upto (after may be None).
+    Returns (scrobbles, next_upto, done); next_upto continues the walk towards older scrobbles.
+    Error replies raise, so a failed fetch never looks like the end of history"""
+    params = {
+        'method': 'user.getrecenttracks',
+        'user': LASTFM_USERNAME,
+        'api_key': LASTFM_API_KEY,
+        'format': 'json',
+        'to': upto + 1,
+        'limit': SCROBBLE_PAGE_SIZE
+    }
+    if after is not None:
+        params['from'] = after
+
+    # Filter on our own bounds so it doesn't matter whether Last.fm treats them as inclusive
+    page_info = {}
+    tracks = iter_recent_tracks(params, priority=priority, page_info=page_info)
+    page = [t for t in tracks if not t.now_playing and t.uts is not None]
+    scrobbles = [t for t in page if t.uts <= upto and (after is None or t.uts > after)]
+
+    # Only Last.fm's paging says whether this is the last page; a short page isn't proof
+    if 'page' not in page_info or 'totalPages' not in page_info:
+        raise LastfmError('user.getrecenttracks reply has no paging @attr')
+    if int(page_info['page']) >= int(page_info['totalPages']):
+        return scrobbles, None, True
+    if not page:
+        raise LastfmError('Empty user.getrecenttracks page before the last page')
+
+    # Scrobbles sharing the oldest timestamp may straddle the page boundary, so leave them
+    # for the next page rather than risk dropping or duplicating any
+    oldest = min(t.uts for t in page)
+    newer = [t for t in scrobbles if t.uts > oldest]
+    if not newer:
+        return scrobbles, oldest - 1, False
+    return newer, oldest, False
+
+def sync_scrobble_frame(backfill_until=None):
+    """Load the scrobble frame after pulling new scrobbles and a few pages of older history.
+    New scrobbles are fetched at interactive
+    priority at most every SCROBBLE_SYNC_INTERVAL seconds; backfill runs as background work
+    and stops once history reaches back to backfill_until (all of it when None).
+    Pages are fetched without holding scrobble_data_lock: one request claims the sync, and
+    concurrent requests serve the current frame until it merges what it fetched"""
+    now = int(time.time())
+    with scrobble_data_lock():
+        frame = ScrobbleFrame.load()
+        if 'head' not in frame.meta:
+            # Nothing newer than now to sync yet, everything older to backfill
+            frame.meta.update(head=now, tail=now, cursor=None, backfillComplete=False)
+        meta = dict(frame.meta)
+
+        forward_due = now - meta.get('syncedAt', 0) >= SCROBBLE_SYNC_INTERVAL
+        backfill_due = not meta['backfillComplete'] and (backfill_until is None or meta['tail'] > backfill_until)
+        if not (forward_due or backfill_due) or meta.get('syncClaimedUntil', 0) > now:
+            return frame
+
+        # Claims expire so a request that died mid-sync doesn't block syncing for good
+        claim = uuid.uuid4().hex
+        frame.meta.update(syncClaim=claim, syncClaimedUntil=now + SCROBBLE_SYNC_CLAIM_TIMEOUT)
+        frame.save()
+
+    scrobbles = []
+    try:
+        if forward_due:
+            # Walk down from now towards head, newest page first
+            if meta['cursor'] is None:
+                meta['cursor'] = meta['syncTarget'] = now
+            for _ in range(SCROBBLE_SYNC_PAGES):
+                page, cursor, done = fetch_scrobble_page(meta['head'], meta['cursor'], PRIORITY_INTERACTIVE)
+                scrobbles.extend(page)
+                if done:
+                    meta['head'] = meta['syncTarget']
+                    meta['cursor'] = None
+                    break
+                meta['cursor'] = cursor
+            meta['syncedAt'] = now
+
+        if backfill_due:
+            for _ in range(SCROBBLE_BACKFILL_PAGES):
+                if backfill_until is not None and meta['tail'] <= backfill_until:
+                    break
+                page, tail, done = fetch_scrobble_page(None, meta['tail'], PRIORITY_BACKGROUND)
+                scrobbles.extend(page)
+                if done:
+                    meta['backfillComplete'] = True
+                    break
+                meta['tail'] = tail
+    except requests.RequestException as e:
+        # Keep what we fetched; syncing resumes from the saved cursors next time
+        print(f"Error syncing scrobble history: {str(e)}")
+
+    with scrobble_data_lock():
+        frame = ScrobbleFrame.load()
+        if frame.meta.get('syncClaim') != claim:
+            # Our claim expired and another request took the sync over
+            return frame
+
+        frame.append(scrobbles)
+        for key in ('head', 'tail', 'cursor', 'syncTarget', 'syncedAt', 'backfillComplete'):
+            if key in meta:
+                frame.meta[key] = meta[key]
+        frame.meta.pop('syncClaim')
+        frame.meta.pop('syncClaimedUntil')
+        frame.save()
+
+    return frame
+
+def utc_offset_seconds():
+    """Client UTC offset from ?utc_offset=<minutes east of UTC>, defaulting to the server's"""
+    from datetime import datetime
+
+    default_minutes = int(datetime.now().astimezone().utcoffset().total_seconds() // 60)
+    return int(request.args.get('utc_offset', default_minutes)) * 60
+
+def distinct_sorted(values):
+    """Distinct values of an already sorted array (cheaper than np.unique, which re-sorts)"""
+    import numpy as np
+
+    if len(values) == 0:
+        return values
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+def bucket_ordinals(local_days, aggregate):
+    """Week (Monday-start) or calendar month number for each local day number"""
+    import numpy as np
+
+    if aggregate == 'month':
+        return local_days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+    # Epoch day 0 was a Thursday
+    return (local_days + 3) // 7
+
+def bucket_start_days(ordinals, aggregate):
+    """Local day number each bucket ordinal starts on"""
+    import numpy as np
+
+    if aggregate == 'month':
+        return ordinals.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+    return ordinals * 7 - 3
+
+# Materialized weekly genre rollups backing genre-profile and top-genres.
+# Until they cover a period those endpoints fall back to top artists and send
+# X-History-Complete: false. Month-by-month evolution is not built from these rollups:
+# genre-timeline?aggregate=month serves it from the scrobble frame, which needs the
+# history backfilled as far back as the buckets reach
+GENRE_ROLLUP_WEEKS_PER_REQUEST = int(os.getenv('GENRE_ROLLUP_WEEKS_PER_REQUEST', '12'))
+CHART_LIST_REFRESH = 3600
+
+# Last.fm period names as days, None for all history
+PERIOD_DAYS = {
+    '7day': 7,
+    '1month': 30,
+    '3month': 90,
+    '6month': 180,
+    '12month': 365,
+    'overall': None
+}
+
+def fold_pending_genres(week, artist_genres):
+    """Move a week's pending artist plays into its genre counts once their genre is known.
+    Artists without tags are dropped, as in the per-request genre counts"""
+    for artist, plays in list(week['pending'].items()):
+        if artist not in artist_genres:
+            continue
+        genre = artist_genres[artist]
+        if genre:
+            week['genres'][genre] = week['genres'].get(genre, 0) + plays
+        del week['pending'][artist]
+
+def sync_genre_rollups():
+    """Bring the per-week genre rollups up to date and return them.
+    The result holds the weekly chart list ('charts'), 'weeks' mapping each built week's start
+    timestamp to its end, genre play counts and artists still awaiting a genre, and
+    'currentWeek', the genre counts of the not-yet-charted current week from the scrobble frame.
+    'currentComplete' is False until the frame covers that week and all its artists have genres.
+    Missing weeks are fetched newest first, GENRE_ROLLUP_WEEKS_PER_REQUEST at a time"""
+    import numpy as np
+
+    now = int(time.time())
+    with scrobble_data_lock():
+        rollups = load_json(data_path('genre_rollups.json'), {'charts': [], 'chartsFetchedAt': 0, 'weeks': {}})
+        refresh_charts = now - rollups['chartsFetchedAt'] >= CHART_LIST_REFRESH
+        missing = [chart for chart in reversed(rollups['charts']) if str(chart[0]) not in rollups['weeks']]
+
+        # Charts and weeks are fetched unlocked by one claiming request, as in sync_scrobble_frame
+        claim = None
+        if (refresh_charts or missing) and rollups.get('syncClaimedUntil', 0) <= now:
+            claim = uuid.uuid4().hex
+            rollups.update(syncClaim=claim, syncClaimedUntil=now + SCROBBLE_SYNC_CLAIM_TIMEOUT)
+            save_json(data_path('genre_rollups.json'), rollups)
+
+    if claim is not None:
+        charts = None
+        weeks = {}
+        try:
+            if refresh_charts:
+                chart_params = {
+                    'method': 'user.getweeklychartlist',
+                    'user': LASTFM_USERNAME,
+                    'api_key': LASTFM_API_KEY,
+                    'format': 'json'
+                }
+                chart_data = lastfm_get(chart_params, priority=PRIORITY_BACKGROUND).json()
+                if 'weeklychartlist' in chart_data and 'chart' in chart_data['weeklychartlist']:
+                    charts = [[int(c['from']), int(c['to'])] for c in chart_data['weeklychartlist']['chart']]
+                    missing = [chart for chart in reversed(charts) if str(chart[0]) not in rollups['weeks']]
+
+            for week_from, week_to in missing[:GENRE_ROLLUP_WEEKS_PER_REQUEST]:
+                artist_params = {
+                    'method': 'user.getweeklyartistchart',
+                    'user': LASTFM_USERNAME,
+                    'api_key': LASTFM_API_KEY,
+                    'format': 'json',
+                    'from': week_from,
+                    'to': week_to
+                }
+                artist_data = lastfm_get(artist_params, priority=PRIORITY_BACKGROUND).json()
+                if 'weeklyartistchart' not in artist_data:
+                    continue
+
+                artists = artist_data['weeklyartistchart'].get('artist', [])
+                if isinstance(artists, dict):
+                    artists = [artists]
+                weeks[str(week_from)] = {
+                    'to': week_to,
+                    'genres': {},
+                    'pending': {artist['name']: int(artist['playcount']) for artist in artists}
+                }
+        except requests.RequestException as e:
+            print(f"Error syncing genre rollups: {str(e)}")
+
+        with scrobble_data_lock():
+            rollups = load_json(data_path('genre_rollups.json'), rollups)
+            if rollups.get('syncClaim') == claim:
+                if charts is not None:
+                    rollups['charts'] = charts
+                    rollups['chartsFetchedAt'] = now
+                for week_from, week in weeks.items():
+                    rollups['weeks'].setdefault(week_from, week)
+                rollups.pop('syncClaim')
+                rollups.pop('syncClaimedUntil')
+                save_json(data_path('genre_rollups.json'), rollups)
+
+    last_charted = rollups['charts'][-1][1] if rollups['charts'] else 0
+
+    # Scrobbles since the last weekly chart, counted per artist
+    frame = sync_scrobble_frame(backfill_until=last_charted)
+    start = np.searchsorted(frame.uts, last_charted, side='right')
+    current_plays = np.bincount(frame.artist_ids[start:], minlength=len(frame.artists))
+    current_artists = {frame.artists[i]: int(current_plays[i]) for i in np.flatnonzero(current_plays)}
+
+    # Resolve genres for the artists with the most unfolded plays first, outside the data lock
+    pending = Counter(current_artists)
+    for week in rollups['weeks'].values():
+        pending.update(week['pending'])
+    artist_genres = resolve_artist_genres([artist for artist, _ in pending.most_common()])
+
+    with scrobble_data_lock():
+        rollups = load_json(data_path('genre_rollups.json'), rollups)
+        weeks = rollups['weeks']
+        if any(week['pending'] for week in weeks.values()):
+            for week in weeks.values():
+                fold_pending_genres(week, artist_genres)
+            save_json(data_path('genre_rollups.json'), rollups)
+
+    current_week = Counter()
+    for artist, plays in current_artists.items():
+        if artist_genres.get(artist):
+            current_week[artist_genres[artist]] += plays
+
+    frame_covers_week = frame.meta['cursor'] is None and (
+        frame.meta['backfillComplete'] or frame.meta['tail'] <= last_charted)
+    rollups['currentWeek'] = current_week
+    rollups['currentComplete'] = (bool(rollups['charts']) and frame_covers_week
+                                  and all(artist in artist_genres for artist in current_artists))
+    return rollups
+
+def period_genre_counts(rollups, period):
+    """Merge the rollups covering a Last.fm period into one genre Counter, or None while any
+    week the period needs isn't fully built yet.
+    Periods are approximated by whole weeks: a week counts if its midpoint is inside the period"""
+    if period not in PERIOD_DAYS:
+        return Counter()
+    if not rollups['currentComplete']:
+        return None
+    days = PERIOD_DAYS[period]
+    cutoff = 0 if days is None else int(time.time()) - days * 86400
+
+    counts = Counter(rollups['currentWeek'])
+    for week_from, week_to in rollups['charts']:
+        if (week_from + week_to) // 2 < cutoff:
+            continue
+        week = rollups['weeks'].get(str(week_from))
+        if week is None or week['pending']:
+            return None
+        counts.update(week['genres'])
+    return counts
+
+def top_artist_genre_counts(period):
+    """Playcount-weighted genres of a period's top artists, straight from user.gettopartists.
+    Used for periods the weekly rollups don't cover yet; like the rollup sync it runs as
+    background work, and the genres it looks up are saved for the rollups to reuse"""
+    params = {
+        'method': 'user.gettopartists',
+        'user': LASTFM_USERNAME,
+        'api_key': LASTFM_API_KEY,
+        'format': 'json',
+        'period': period,
+        'limit': TOP_ARTISTS_WEEK_LIMIT
+    }
+    data = lastfm_get(params, priority=PRIORITY_BACKGROUND).json()
+    top_artists = data['topartists']['artist']
+    artist_genres = resolve_artist_genres([artist['name'] for artist in top_artists], limit=len(top_artists))
+
+    genre_counts = Counter()
+    for artist in top_artists:
+        genre = artist_genres.get(artist['name'])
+        if genre:
+            # Weight by playcount
+            genre_counts[genre] += int(artist['playcount'])
+    return genre_counts
+
+def rollup_genre_counts(rollups, period):
+    """Genre counts for a period from the rollups, falling back to top artists until they cover it.
+    Returns (counts, complete); complete is False for the fallback, which only weights the top
+    TOP_ARTISTS_WEEK_LIMIT artists rather than every charted artist"""
+    counts = period_genre_counts(rollups, period)
+    if counts is None:
+        return top_artist_genre_counts(period), False
+    return counts, True
+
+def genre_percentages(counts_by_key, top=8):
+    """Convert genre Counters to percentages of each total, for the top genres across all of them"""
+    all_genres = Counter()
+    for counts in counts_by_key.values():
+        all_genres.update(counts)
+    top_genres = [genre for genre, _ in all_genres.most_common(top)]
+
+    result = {}
+    for key, counts in counts_by_key.items():
+        total_plays = sum(counts.values())
+        if total_plays > 0:
+            result[key] = {genre: round((counts.get(genre, 0) / total_plays) * 100, 1) for genre in top_genres}
+        else:
+            result[key] = {genre: 0 for genre in top_genres}
+    return result
+
+@app.before_request
+def start_request_profile():
+    g.upstream_wait = 0.0
+    g.upstream_calls = 0
+    g.queue_wait = 0.0
+    g.request_started = time.perf_counter()
+    g.request_cpu_started = time.process_time()
+
+    if not should_profile_request():
+        return
+
+    # Profile CPU time only; upstream waits are tracked separately by lastfm_get
+    profiler = cProfile.Profile(time.process_time)
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already active in this process
+        return
+    g.profiler = profiler
+
+@app.after_request
+def finish_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+
+    profiler.disable()
+    meta = {
+        'route': request.url_rule.rule if request.url_rule else request.path,
+        'path': profiled_path(),
+        'method': request.method,
+        'status': response.status_code,
+        'timestamp': int(time.time()),
+        'wallMs': round((time.perf_counter() - g.request_started) * 1000, 1),
+        'cpuMs': round((time.process_time() - g.request_cpu_started) * 1000, 1),
+        'upstreamWaitMs': round(g.upstream_wait * 1000, 1),
+        'queueWaitMs': round(g.queue_wait * 1000, 1),
+        'upstreamCalls': g.upstream_calls
+    }
+    try:
+        save_profile(profiler, meta)
+        response.headers['X-Profile-File'] = meta['file']
+    except OSError as e:
+        print(f"Error saving profile for {meta['path']}: {str(e)}")
+
+    return response
+
+@app.teardown_request
+def stop_request_profile(exc):
+    # after_request is skipped when a view raises, so make sure the profiler is off
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+@app.route('/api/admin/profiles')
+def admin_profiles():
+    if not is_admin_request():
+        abort(403)
+    return jsonify(list_profiles())
+
+@app.route('/api/admin/scheduler')
+def admin_scheduler():
+    if not is_admin_request():
+        abort(403)
+    return jsonify(scheduler_snapshot())
+
+@app.route('/api/admin/profiles/<name>')
+def admin_profile_download(name):
+    if not is_admin_request():
+        abort(403)
+    if not name.endswith('.pstats'):
+        abort(404)
+    return send_from_directory(PROFILE_DIR, name, as_attachment=True)
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/api/lastfm/last-played')
-@cache.cached(timeout=30)
+@cache.cached(timeout=30, unless=is_profiling)
 def last_played():
-    url = f'https://ws.audioscrobbler.com/2.0/'
     params = {
         'method': 'user.getrecenttracks',
         'user': LASTFM_USERNAME,
@@ -61,7 +1066,7 @@ def last_played():
         'limit': 1
     }
 
-    response = requests.get(url, params=params, timeout=10)
+    response = lastfm_get(params, priority=PRIORITY_NOW_PLAYING)
     data = response.json()
 
     track = data['recenttracks']['track'][0]
@@ -77,7 +1082,7 @@ def last_played():
         'api_key': LASTFM_API_KEY,
         'format': 'json'
     }
-    track_info_response = requests.get(url, params=track_info_params, timeout=10)
+    track_info_response = lastfm_get(track_info_params, priority=PRIORITY_NOW_PLAYING)
     track_info = track_info_response.json()
 
     # Extract top tag as genre
@@ -103,7 +1108,7 @@ def last_played():
             'api_key': LASTFM_API_KEY,
             'format': 'json'
         }
-        artist_info_response = requests.get(url, params=artist_info_params, timeout=10)
+        artist_info_response = lastfm_get(artist_info_params, priority=PRIORITY_NOW_PLAYING)
         artist_info = artist_info_response.json()
 
         if 'artist' in artist_info and 'stats' in artist_info['artist']:
@@ -129,9 +1134,8 @@ def last_played():
     return jsonify(result)
 
 @app.route('/api/lastfm/recent-tracks')
-@cache.cached(timeout=30)
+@cache.cached(timeout=30, unless=is_profiling)
 def recent_tracks():
-    url = f'https://ws.audioscrobbler.com/2.0/'
     params = {
         'method': 'user.getrecenttracks',
         'user': LASTFM_USERNAME,
@@ -140,7 +1144,7 @@ def recent_tracks():
         'limit': RECENT_TRACKS_LIMIT + 1  # Get one extra to skip the first one
     }
 
-    response = requests.get(url, params=params, timeout=10)
+    response = lastfm_get(params)
     data = response.json()
 
     # Process/simplify the data, skip first track (it's in hero section)
@@ -167,7 +1171,7 @@ def recent_tracks():
                     'api_key': LASTFM_API_KEY,
                     'format': 'json'
                 }
-                track_info_response = requests.get(url, params=track_info_params, timeout=10)
+                track_info_response = lastfm_get(track_info_params)
                 track_info = track_info_response.json()
 
                 # Extract top tag as genre
@@ -197,7 +1201,7 @@ def recent_tracks():
                 'api_key': LASTFM_API_KEY,
                 'format': 'json'
             }
-            artist_info_response = requests.get(url, params=artist_info_params, timeout=10)
+            artist_info_response = lastfm_get(artist_info_params)
             artist_info = artist_info_response.json()
 
             if 'artist' in artist_info and 'stats' in artist_info['artist']:
@@ -222,7 +1226,7 @@ def recent_tracks():
     return jsonify(tracks)
 
 @app.route('/api/lastfm/top-artists')
-@cache.cached(timeout=300, query_string=True)
+@cache.cached(timeout=300, query_string=True, unless=is_profiling)
 def top_artists():
     # Get period from query parameter, default to 7day
     from flask import request
@@ -233,7 +1237,6 @@ def top_artists():
     if period not in valid_periods:
         period = '7day'
 
-    url = f'https://ws.audioscrobbler.com/2.0/'
     params = {
         'method': 'user.gettopartists',
         'user': LASTFM_USERNAME,
@@ -243,7 +1246,7 @@ def top_artists():
         'limit': TOP_ARTISTS_WEEK_LIMIT
     }
 
-    response = requests.get(url, params=params, timeout=10)
+    response = lastfm_get(params)
     data = response.json()
 
     # Process/simplify the data and fetch artist info for hipster score
@@ -256,7 +1259,7 @@ def top_artists():
             'api_key': LASTFM_API_KEY,
             'format': 'json'
         }
-        artist_info_response = requests.get(url, params=artist_info_params, timeout=10)
+        artist_info_response = lastfm_get(artist_info_params)
         artist_info = artist_info_response.json()
 
         listeners = int(artist_info['artist']['stats']['listeners'])
@@ -282,9 +1285,8 @@ def top_artists():
     return jsonify(artists)
 
 @app.route('/api/lastfm/top-artists-year')
-@cache.cached(timeout=3600)
+@cache.cached(timeout=3600, unless=is_profiling)
 def top_artists_year():
-    url = f'https://ws.audioscrobbler.com/2.0/'
     params = {
         'method': 'user.gettopartists',
         'user': LASTFM_USERNAME,
@@ -294,7 +1296,7 @@ def top_artists_year():
         'limit': TOP_ARTISTS_YEAR_LIMIT
     }
 
-    response = requests.get(url, params=params, timeout=10)
+    response = lastfm_get(params)
     data = response.json()
 
     # Process/simplify the data and fetch artist info for hipster score
@@ -307,7 +1309,7 @@ def top_artists_year():
             'api_key': LASTFM_API_KEY,
             'format': 'json'
         }
-        artist_info_response = requests.get(url, params=artist_info_params, timeout=10)
+        artist_info_response = lastfm_get(artist_info_params)
         artist_info = artist_info_response.json()
 
         listeners = int(artist_info['artist']['stats']['listeners'])
@@ -333,9 +1335,8 @@ def top_artists_year():
     return jsonify(artists)
 
 @app.route('/api/lastfm/weekly-chart-list')
-@cache.cached(timeout=3600)
+@cache.cached(timeout=3600, unless=is_profiling)
 def weekly_chart_list():
-    url = f'https://ws.audioscrobbler.com/2.0/'
     params = {
         'method': 'user.getweeklychartlist',
         'user': LASTFM_USERNAME,
@@ -343,7 +1344,7 @@ def weekly_chart_list():
         'format': 'json'
     }
 
-    response = requests.get(url, params=params, timeout=10)
+    response = lastfm_get(params)
     data = response.json()
 
     # Return the chart list
@@ -354,141 +1355,53 @@ def weekly_chart_list():
     return jsonify([])
 
 @app.route('/api/lastfm/genre-profile')
-@cache.cached(timeout=300, query_string=True)
+@cache.cached(timeout=300, query_string=True, unless=is_profiling)
 def genre_profile():
     from flask import request
-    from collections import Counter
 
     # Get periods from query parameter (comma-separated)
     periods_param = request.args.get('periods', '1month,3month')
     periods = [p.strip() for p in periods_param.split(',')]
 
-    url = f'https://ws.audioscrobbler.com/2.0/'
-
-    # First pass: collect all genres across all periods to find top 8 overall
-    all_genres = Counter()
+    # Each period is a merge of the materialized weekly rollups once they cover it
+    rollups = sync_genre_rollups()
     period_data = {}
-
-    for period in periods:
-        # Fetch top artists for this period
-        params = {
-            'method': 'user.gettopartists',
-            'user': LASTFM_USERNAME,
-            'api_key': LASTFM_API_KEY,
-            'format': 'json',
-            'period': period,
-            'limit': TOP_ARTISTS_WEEK_LIMIT
-        }
-        response = requests.get(url, params=params, timeout=10)
-        data = response.json()
-
-        # Collect all genres with playcount weighting
-        genre_counts = Counter()
-
-        for artist in data['topartists']['artist']:
-            # Fetch artist info to get genre
-            artist_info_params = {
-                'method': 'artist.getinfo',
-                'artist': artist['name'],
-                'api_key': LASTFM_API_KEY,
-                'format': 'json'
-            }
-            artist_info_response = requests.get(url, params=artist_info_params, timeout=10)
-            artist_info = artist_info_response.json()
-
-            # Extract top tag as genre
-            genre = ''
-            if 'artist' in artist_info and 'tags' in artist_info['artist'] and 'tag' in artist_info['artist']['tags']:
-                tags = artist_info['artist']['tags']['tag']
-                if isinstance(tags, list) and len(tags) > 0:
-                    genre = tags[0]['name'].lower()
-                    # Weight by playcount
-                    playcount = int(artist['playcount'])
-                    genre_counts[genre] += playcount
-                    all_genres[genre] += playcount
-
-        period_data[period] = genre_counts
-
-    # Get top 8 genres overall
-    top_8_genres = [genre for genre, _ in all_genres.most_common(8)]
-
-    # Second pass: convert to percentages for each period
-    result = {}
+    history_complete = True
     for period in periods:
-        # Calculate total plays for this period
-        total_plays = sum(period_data[period].values())
+        period_data[period], complete = rollup_genre_counts(rollups, period)
+        history_complete = history_complete and complete
 
-        # Convert each genre to percentage of total
-        if total_plays > 0:
-            result[period] = {
-                genre: round((period_data[period].get(genre, 0) / total_plays) * 100, 1)
-                for genre in top_8_genres
-            }
-        else:
-            result[period] = {genre: 0 for genre in top_8_genres}
-
-    return jsonify(result)
+    # Percentages of each period's plays for the top 8 genres overall
+    response = jsonify(genre_percentages(period_data, top=8))
+    response.headers['X-History-Complete'] = 'true' if history_complete else 'false'
+    return response
 
 @app.route('/api/lastfm/top-genres')
-@cache.cached(timeout=300, query_string=True)
+@cache.cached(timeout=300, query_string=True, unless=is_profiling)
 def top_genres():
     from flask import request
-    from collections import Counter
 
     # Get period from query parameter
     period = request.args.get('period', '1month')
 
-    url = f'https://ws.audioscrobbler.com/2.0/'
-
-    # Fetch top artists for this period
-    params = {
-        'method': 'user.gettopartists',
-        'user': LASTFM_USERNAME,
-        'api_key': LASTFM_API_KEY,
-        'format': 'json',
-        'period': period,
-        'limit': TOP_ARTISTS_WEEK_LIMIT
-    }
-    response = requests.get(url, params=params, timeout=10)
-    data = response.json()
-
-    # Collect all genres with playcount weighting
-    genre_counts = Counter()
-
-    for artist in data['topartists']['artist']:
-        # Fetch artist info to get genre
-        artist_info_params = {
-            'method': 'artist.getinfo',
-            'artist': artist['name'],
-            'api_key': LASTFM_API_KEY,
-            'format': 'json'
-        }
-        artist_info_response = requests.get(url, params=artist_info_params, timeout=10)
-        artist_info = artist_info_response.json()
-
-        # Extract top tag as genre
-        if 'artist' in artist_info and 'tags' in artist_info['artist'] and 'tag' in artist_info['artist']['tags']:
-            tags = artist_info['artist']['tags']['tag']
-            if isinstance(tags, list) and len(tags) > 0:
-                genre = tags[0]['name'].lower()
-                # Weight by playcount
-                genre_counts[genre] += int(artist['playcount'])
+    rollups = sync_genre_rollups()
+    genre_counts, history_complete = rollup_genre_counts(rollups, period)
 
     # Get top 10 genres with raw counts
     top_10 = [{'genre': genre, 'count': count} for genre, count in genre_counts.most_common(10)]
 
-    return jsonify(top_10)
+    response = jsonify(top_10)
+    response.headers['X-History-Complete'] = 'true' if history_complete else 'false'
+    return response
 
 @app.route('/api/lastfm/music-stats')
-@cache.cached(timeout=300, query_string=True)
+@cache.cached(timeout=300, query_string=True, unless=is_profiling)
 def music_stats():
     from flask import request
 
     # Get period from query parameter
     period = request.args.get('period', '1month')
 
-    url = f'https://ws.audioscrobbler.com/2.0/'
-
     # Fetch top artists for this period (uses cache!)
     params = {
         'method': 'user.gettopartists',
@@ -498,7 +1411,7 @@ def music_stats():
         'period': period,
         'limit': TOP_ARTISTS_WEEK_LIMIT
     }
-    response = requests.get(url, params=params, timeout=10)
+    response = lastfm_get(params)
     data = response.json()
 
     hipster_scores = []
@@ -521,7 +1434,7 @@ def music_stats():
             'api_key': LASTFM_API_KEY,
             'format': 'json'
         }
-        artist_info_response = requests.get(url, params=artist_info_params, timeout=10)
+        artist_info_response = lastfm_get(artist_info_params)
         artist_info = artist_info_response.json()
 
         listeners = int(artist_info['artist']['stats']['listeners'])
@@ -564,7 +1477,7 @@ def music_stats():
     return jsonify(result)
 
 @app.route('/api/lastfm/artist-history/<artist_name>')
-@cache.cached(timeout=3600, query_string=True)
+@cache.cached(timeout=3600, query_string=True, unless=is_profiling)
 def artist_history(artist_name):
     from flask import request
     from datetime import datetime, timedelta
@@ -575,8 +1488,6 @@ def artist_history(artist_name):
     weeks = int(request.args.get('weeks', '12'))
     aggregate = request.args.get('aggregate', 'week')
 
-    url = f'https://ws.audioscrobbler.com/2.0/'
-
     # Handle daily aggregation differently
     if aggregate == 'day':
         # Fetch recent tracks and group by day
@@ -594,38 +1505,26 @@ def artist_history(artist_name):
             'limit': 1000  # Max limit
         }
 
-        response = requests.get(url, params=recent_params, timeout=10)
-        data = response.json()
-
         # Group tracks by day and count plays per artist
         daily_counts = defaultdict(int)
 
-        if 'recenttracks' in data and 'track' in data['recenttracks']:
-            tracks = data['recenttracks']['track']
-            if not isinstance(tracks, list):
-                tracks = [tracks]
-
-            for track in tracks:
-                # Skip if currently playing
-                if '@attr' in track and track['@attr'].get('nowplaying') == 'true':
-                    continue
-
-                # Skip if no date
-                if 'date' not in track:
+        # Stream the page so the 1000-track response is never fully decoded in memory
+        try:
+            for track in iter_recent_tracks(recent_params, priority=PRIORITY_BACKGROUND):
+                # Skip if currently playing or no date
+                if track.now_playing or track.uts is None:
                     continue
 
-                # Get artist name
-                track_artist = track['artist']['#text'] if isinstance(track['artist'], dict) else track['artist']
-
                 # Only count if it's the artist we're looking for
-                if track_artist.lower() == artist_name.lower():
-                    timestamp = int(track['date']['uts'])
+                if track.artist.lower() == artist_name.lower():
                     # Get day (midnight timestamp)
-                    dt = datetime.fromtimestamp(timestamp)
+                    dt = datetime.fromtimestamp(track.uts)
                     day_start = datetime(dt.year, dt.month, dt.day)
                     day_timestamp = int(day_start.timestamp())
 
                     daily_counts[day_timestamp] += 1
+        except requests.RequestException as e:
+            print(f"Error fetching recent tracks for {artist_name}: {str(e)}")
 
         # Create result for last N days (even if no plays)
         history = []
@@ -654,7 +1553,7 @@ def artist_history(artist_name):
         'format': 'json'
     }
 
-    chart_response = requests.get(url, params=chart_params, timeout=10)
+    chart_response = lastfm_get(chart_params, priority=PRIORITY_BACKGROUND)
     chart_data = chart_response.json()
 
     if 'weeklychartlist' not in chart_data or 'chart' not in chart_data['weeklychartlist']:
@@ -677,7 +1576,7 @@ def artist_history(artist_name):
             'to': chart['to']
         }
 
-        artist_response = requests.get(url, params=artist_params, timeout=10)
+        artist_response = lastfm_get(artist_params, priority=PRIORITY_BACKGROUND)
         artist_data = artist_response.json()
 
         # Find the specific artist in this week's chart
@@ -711,25 +1610,16 @@ def artist_history(artist_name):
                 'limit': 1000
             }
 
-            recent_response = requests.get(url, params=recent_params, timeout=10)
-            recent_data = recent_response.json()
-
             # Count plays for this artist in the current period
             current_playcount = 0
-            if 'recenttracks' in recent_data and 'track' in recent_data['recenttracks']:
-                tracks = recent_data['recenttracks']['track']
-                if not isinstance(tracks, list):
-                    tracks = [tracks]
-
-                for track in tracks:
-                    if '@attr' in track and track['@attr'].get('nowplaying') == 'true':
-                        continue
-                    if 'date' not in track:
+            try:
+                for track in iter_recent_tracks(recent_params, priority=PRIORITY_BACKGROUND):
+                    if track.now_playing or track.uts is None:
                         continue
-
-                    track_artist = track['artist']['#text'] if isinstance(track['artist'], dict) else track['artist']
-                    if track_artist.lower() == artist_name.lower():
+                    if track.artist.lower() == artist_name.lower():
                         current_playcount += 1
+            except requests.RequestException as e:
+                print(f"Error fetching recent tracks for {artist_name}: {str(e)}")
 
             # Append current period
             history.append({
@@ -765,5 +1655,156 @@ def artist_history(artist_name):
 
     return jsonify(history)
 
+@app.route('/api/lastfm/listening-heatmap')
+@cache.cached(timeout=300, query_string=True, unless=is_profiling)
+def listening_heatmap():
+    import numpy as np
+
+    # Number of days to include, 0 for all history
+    days = int(request.args.get('days', '0'))
+    offset = utc_offset_seconds()
+
+    frame = sync_scrobble_frame()
+    uts = frame.uts
+    if days > 0:
+        uts = uts[np.searchsorted(uts, int(time.time()) - days * 86400):]
+
+    local = uts + offset
+    weekday = (local // 86400 + 3) % 7  # Monday = 0
+    hour = local % 86400 // 3600
+    counts = np.bincount(weekday * 24 + hour, minlength=7 * 24).reshape(7, 24)
+
+    return jsonify({
+        'days': ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'],
+        'counts': counts.tolist(),
+        'scrobbles': int(len(uts)),
+        'historyComplete': frame.meta['backfillComplete']
+    })
+
+@app.route('/api/lastfm/listening-streaks')
+@cache.cached(timeout=300, query_string=True, unless=is_profiling)
+def listening_streaks():
+    import numpy as np
+
+    offset = utc_offset_seconds()
+
+    frame = sync_scrobble_frame()
+    active_days = distinct_sorted((frame.uts + offset) // 86400)
+
+    def streak(start_day, end_day):
+        return {
+            'days': int(end_day - start_day + 1),
+            'start': int(start_day * 86400 - offset),
+            'end': int(end_day * 86400 - offset)
+        }
+
+    result = {
+        'current': {'days': 0, 'start': None, 'end': None},
+        'longest': {'days': 0, 'start': None, 'end': None},
+        'activeDays': int(len(active_days)),
+        'historyComplete': frame.meta['backfillComplete']
+    }
+
+    if len(active_days) > 0:
+        # Runs of consecutive days split wherever the gap is more than one day
+        breaks = np.flatnonzero(np.diff(active_days) != 1)
+        run_starts = active_days[np.concatenate([[0], breaks + 1])]
+        run_ends = active_days[np.concatenate([breaks, [len(active_days) - 1]])]
+        longest = int(np.argmax(run_ends - run_starts))
+        result['longest'] = streak(run_starts[longest], run_ends[longest])
+
+        # The current streak is still alive if there were plays today or yesterday
+        today = (int(time.time()) + offset) // 86400
+        if run_ends[-1] >= today - 1:
+            result['current'] = streak(run_starts[-1], run_ends[-1])
+
+    return jsonify(result)
+
+@app.route('/api/lastfm/discovery-rate')
+@cache.cached(timeout=300, query_string=True, unless=is_profiling)
+def discovery_rate():
+    import numpy as np
+
+    aggregate = request.args.get('aggregate', 'week')
+    if aggregate not in ['week', 'month']:
+        aggregate = 'week'
+    buckets = max(1, int(request.args.get('buckets', '12')))
+    offset = utc_offset_seconds()
+
+    frame = sync_scrobble_frame()
+    n_artists = max(frame.artist_count, 1)
+
+    current = int(bucket_ordinals(np.array([(int(time.time()) + offset) // 86400]), aggregate)[0])
+    first = current - buckets + 1
+    rel = bucket_ordinals((frame.uts + offset) // 86400, aggregate) - first
+    in_window = (rel >= 0) & (rel < buckets)
+
+    # Rows are time sorted, so each artist's lowest row is their first ever scrobble
+    first_rows = np.full(n_artists, len(frame.uts), np.int64)
+    np.minimum.at(first_rows, frame.artist_ids, np.arange(len(frame.uts)))
+    first_rel = rel[first_rows[first_rows < len(frame.uts)]]
+    new_artists = np.bincount(first_rel[(first_rel >= 0) & (first_rel < buckets)], minlength=buckets)
+
+    # Distinct artists per bucket via unique (bucket, artist) pairs
+    pairs = distinct_sorted(np.sort(rel[in_window] * n_artists + frame.artist_ids[in_window]))
+    artists = np.bincount(pairs // n_artists, minlength=buckets)
+    scrobbles = np.bincount(rel[in_window], minlength=buckets)
+
+    starts = bucket_start_days(np.arange(first, current + 1), aggregate) * 86400 - offset
+    history = [
+        {
+            'start': int(starts[i]),
+            'newArtists': int(new_artists[i]),
+            'artists': int(artists[i]),
+            'scrobbles': int(scrobbles[i]),
+            'discoveryRate': round(new_artists[i] / artists[i] * 100, 1) if artists[i] else 0
+        }
+        for i in range(buckets)
+    ]
+
+    return jsonify({'buckets': history, 'historyComplete': frame.meta['backfillComplete']})
+
+@app.route('/api/lastfm/genre-timeline')
+@cache.cached(timeout=300, query_string=True, unless=is_profiling)
+def genre_timeline():
+    import numpy as np
+
+    aggregate = request.args.get('aggregate', 'week')
+    if aggregate not in ['week', 'month']:
+        aggregate = 'week'
+    buckets = max(1, int(request.args.get('buckets', '12')))
+    top = max(0, int(request.args.get('top', '8')))
+    # percent=true gives each genre's share of the bucket's tagged plays instead of counts
+    percent = request.args.get('percent', 'false').lower() == 'true'
+    offset = utc_offset_seconds()
+
+    frame = sync_scrobble_frame()
+    artist_genres = resolve_artist_genres(frame.artists_by_plays())
+    genre_ids, genres = frame.genre_ids(artist_genres)
+    n_genres = max(len(genres), 1)
+
+    current = int(bucket_ordinals(np.array([(int(time.time()) + offset) // 86400]), aggregate)[0])
+    first = current - buckets + 1
+    rel = bucket_ordinals((frame.uts + offset) // 86400, aggregate) - first
+    in_window = (rel >= 0) & (rel < buckets)
+    known = in_window & (genre_ids >= 0)
+
+    # buckets x genres play counts in a single bincount
+    counts = np.bincount(rel[known] * n_genres + genre_ids[known], minlength=buckets * n_genres).reshape(buckets, n_genres)
+    unknown = np.bincount(rel[in_window & (genre_ids < 0)], minlength=buckets)
+    top_genres = [int(i) for i in np.argsort(-counts.sum(axis=0), kind='stable')[:top] if counts[:, i].sum() > 0]
+
+    values = counts
+    if percent:
+        values = np.round(counts / np.maximum(counts.sum(axis=1, keepdims=True), 1) * 100, 1)
+
+    starts = bucket_start_days(np.arange(first, current + 1), aggregate) * 86400 - offset
+    return jsonify({
+        'buckets': [int(start) for start in starts],
+        'genres': {genres[i]: values[:, i].tolist() for i in top_genres},
+        'unknown': unknown.tolist(),
+        'historyComplete': frame.meta['backfillComplete']
+    })
+
 if __name__ == '__main__':
     app.run()
\ No newline at end of file